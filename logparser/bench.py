@@ -0,0 +1,285 @@
+import argparse
+import importlib.util
+import json
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from . import __version__
+from .main import FORMATS
+from .models import LogBatch
+from .parser import LogParser
+from .utils import get_output_path, open_log_file
+from .writer import Writer
+
+METHODS = ['GET'] * 16 + ['POST'] * 2 + ['HEAD', 'OPTIONS']
+
+STATUS = [200] * 20 + [206, 301, 302, 304, 304, 403, 404, 404, 500]
+
+PATHS = ['/', '/index.html', '/about/', '/api/v1/items/', '/api/v1/items/{}/', '/static/css/style.css',
+         '/static/js/app.js', '/images/{}.png', '/search/', '/blog/{}/']
+
+BROWSERS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{}.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/{}.1 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:{}.0) Gecko/20100101 Firefox/{}.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_{} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+    'Mozilla/5.0 (Linux; Android {}; Pixel 7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html) v{}',
+    'curl/7.{}.0',
+    'python-requests/2.{}.0'
+]
+
+REFERRERS = ['-', '-', '-', 'https://www.google.com/', 'https://example.com/', 'https://example.com/search/?q={}']
+
+logger = logging.getLogger(__name__)
+
+
+def generate_log(path, lines, user_agents=100, hosts=1000, malformed=0.001, seed=0):
+    # write a synthetic log in the combined log format, compressed if the path ends with .gz or .xz
+    rng = random.Random(seed)
+
+    user_agent_pool = [rng.choice(BROWSERS).format(i, i) for i in range(user_agents)]
+    host_pool = [
+        f'2001:db8::{i:x}' if i % 10 == 0 else f'{rng.randint(1, 223)}.{rng.randint(0, 255)}.{i // 256 % 256}.{i % 256}'
+        for i in range(hosts)
+    ]
+
+    start_time = datetime(2024, 1, 1, tzinfo=timezone(timedelta(hours=1)))
+    with open_log_file(path, 'wt', log=False) as fp:
+        for i in range(lines):
+            if rng.random() < malformed:
+                fp.write(f'malformed line {i}\n')
+                continue
+
+            time = (start_time + timedelta(seconds=i // 10)).strftime('%d/%b/%Y:%H:%M:%S %z')
+            request_path = rng.choice(PATHS).format(rng.randint(1, 1000))
+            query = f'?page={rng.randint(1, 10)}' if rng.random() < 0.1 else ''
+            referrer = rng.choice(REFERRERS).format(rng.randint(1, 1000))
+            size = '-' if rng.random() < 0.05 else rng.randint(0, 100000)
+
+            fp.write(f'{rng.choice(host_pool)} - - [{time}] "{rng.choice(METHODS)} {request_path}{query} HTTP/1.1" '
+                     f'{rng.choice(STATUS)} {size} "{referrer}" "{rng.choice(user_agent_pool)}"\n')
+
+
+def measure(function, *args):
+    # run the function once to measure the time and once more to measure the peak memory
+    start = time.perf_counter()
+    function(*args)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak
+
+
+def bench_read(input_path):
+    with open_log_file(input_path, log=False) as fp:
+        for line in fp:
+            pass
+
+
+def bench_match(parser_kwargs, lines):
+    parser = LogParser(**parser_kwargs)
+    for line in lines:
+        parser.match_line(line)
+
+
+def bench_time(parser_kwargs, matches):
+    parser = LogParser(**parser_kwargs)
+    for match in matches:
+        parser.parse_time(match.group('time'))
+
+
+def bench_user_agent(parser_kwargs, matches):
+    parser = LogParser(**parser_kwargs)
+    for match in matches:
+        parser.parse_user_agent(match.group('agent'))
+
+
+def bench_geoip(parser_kwargs, matches, chunking):
+    parser = LogParser(**parser_kwargs)
+    for i in range(0, len(matches), chunking):
+        parser.geoip_index.lookup_many(match.group('host') for match in matches[i:i + chunking])
+    parser.close()
+
+
+def bench_anon(parser_kwargs, matches):
+    parser = LogParser(**parser_kwargs)
+    for match in matches:
+        time = parser.parse_time(match.group('time'))
+        parser.get_remote_host(match.group('host'), time, match.group('agent'))
+
+
+def bench_parse(parser_kwargs, lines, chunking):
+    parser = LogParser(**parser_kwargs)
+    for i in range(0, len(lines), chunking):
+        parser.parse_lines(lines[i:i + chunking])
+    parser.close()
+
+
+def bench_write(output_format, output_path, database_settings, log_batches):
+    writer = Writer(format=output_format, path=output_path, database_settings=database_settings)
+    writer.open()
+    for log_batch in log_batches:
+        writer.extend(log_batch)
+        writer.write()
+    writer.close()
+
+
+def bench_write_sql(database_path, log_batches):
+    database_path.unlink(missing_ok=True)
+    bench_write('sql', None, f'sqlite:///{database_path}', log_batches)
+
+
+def bench_write_sql_orm(database_path, log_batches):
+    # the implementation before the bulk insert: ORM objects and deduplication using the sha1 of the current day
+    from .database import Record, create_session, get_current_records
+
+    database_path.unlink(missing_ok=True)
+    session = create_session(f'sqlite:///{database_path}')
+
+    current_date, current_records = None, set()
+    for log_batch in log_batches:
+        records = []
+        for row in log_batch:
+            log_entry = dict(zip(log_batch.fields, row))
+
+            entry_date = log_entry['time'].date()
+            if entry_date != current_date:
+                current_date = entry_date
+                current_records = get_current_records(session, entry_date)
+
+            if log_entry['sha1'] not in current_records:
+                current_records.add(log_entry['sha1'])
+                records.append(Record(**log_entry))
+
+        session.bulk_save_objects(records)
+        session.commit()
+
+    session.close()
+
+
+def run(args, tmp_dir):
+    input_path = Path(args.input_path) if args.input_path else tmp_dir / f'access.log{args.compression or ""}'
+    if not args.input_path:
+        logger.info('generate %s', input_path)
+        generate_log(input_path, args.lines, user_agents=args.user_agents, hosts=args.hosts,
+                     malformed=args.malformed, seed=args.seed)
+
+    parser_kwargs = {'geoip2_database': args.geoip2_database}
+
+    # prepare the inputs for the single stages, this is not measured
+    with open_log_file(input_path, log=False) as fp:
+        lines = fp.readlines()
+
+    parser = LogParser(**parser_kwargs)
+    matches = [match for match in map(parser.match_line, lines) if match]
+
+    log_batches = []
+    for i in range(0, len(lines), args.chunking):
+        log_batch = LogBatch()
+        log_batch.extend(log_entry for log_entry, line in parser.parse_lines(lines[i:i + args.chunking]))
+        log_batches.append(log_batch)
+    parser.close()
+
+    stages = [
+        ('read', bench_read, input_path),
+        ('match', bench_match, parser_kwargs, lines),
+        ('time', bench_time, parser_kwargs, matches),
+        ('user_agent', bench_user_agent, parser_kwargs, matches),
+        ('anon', bench_anon, {'anon': 'daily', 'salts': tmp_dir / 'salts'}, matches),
+        ('parse', bench_parse, parser_kwargs, lines, args.chunking)
+    ]
+
+    if args.geoip2_database:
+        stages.append(('geoip', bench_geoip, parser_kwargs, matches, args.chunking))
+
+    for output_format in args.formats:
+        if output_format == 'sql':
+            stages.append(('write_sql', bench_write_sql, tmp_dir / 'bench.sqlite3', log_batches))
+            stages.append(('write_sql_orm', bench_write_sql_orm, tmp_dir / 'bench.sqlite3', log_batches))
+        else:
+            output_path = get_output_path(input_path, tmp_dir / 'output', output_format)
+            stages.append((f'write_{output_format}', bench_write, output_format, output_path, None, log_batches))
+
+    results = {
+        'version': __version__,
+        'lines': len(lines),
+        'input_path': str(input_path),
+        'input_size': input_path.stat().st_size,
+        'stages': {}
+    }
+
+    for name, function, *function_args in stages:
+        logger.info('run %s', name)
+        seconds, peak = measure(function, *function_args)
+        results['stages'][name] = {
+            'seconds': round(seconds, 3),
+            'lines_per_second': round(len(lines) / seconds) if seconds else None,
+            'peak_memory': peak
+        }
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of logparser on a synthetic log')
+    parser.add_argument('input_path', metavar='path', nargs='?',
+                        help='Optional log file to use instead of a synthetic log')
+    parser.add_argument('--lines', dest='lines', type=int, default=100000,
+                        help='Number of lines of the synthetic log [default: 100000]')
+    parser.add_argument('--user-agents', dest='user_agents', type=int, default=100,
+                        help='Number of distinct user agents in the synthetic log [default: 100]')
+    parser.add_argument('--hosts', dest='hosts', type=int, default=1000,
+                        help='Number of distinct remote hosts in the synthetic log [default: 1000]')
+    parser.add_argument('--malformed', dest='malformed', type=float, default=0.001,
+                        help='Ratio of malformed lines in the synthetic log [default: 0.001]')
+    parser.add_argument('--compression', dest='compression', choices=['.gz', '.xz'],
+                        help='Compression of the synthetic log')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Seed for the synthetic log [default: 0]')
+    parser.add_argument('--chunking', dest='chunking', type=int, default=10000,
+                        help='Number of lines processed at once [default: 10000]')
+    parser.add_argument('--format', dest='formats', action='append', choices=FORMATS,
+                        help='Output formats to benchmark, can be repeated [default: all]')
+    parser.add_argument('--geoip2-database', dest='geoip2_database',
+                        help='Path to the geoip2 database, enables the geoip stage')
+    parser.add_argument('--output', dest='output',
+                        help='Path to a json file for the results [default: stdout]')
+    parser.add_argument('--log-level', dest='log_level', default='WARN',
+                        help='Log level (ERROR, WARN, INFO, or DEBUG)')
+
+    args = parser.parse_args()
+    # by default, the formats whose optional dependencies are missing are skipped
+    args.formats = args.formats or [
+        output_format for output_format in FORMATS
+        if (output_format not in ['parquet', 'arrow'] or importlib.util.find_spec('pyarrow')) and
+           (output_format != 'sql' or importlib.util.find_spec('sqlalchemy')) and
+           (not output_format.endswith('.zst') or shutil.which('zstd') or importlib.util.find_spec('zstandard'))
+    ]
+
+    logging.basicConfig(level=args.log_level.upper(), format='[%(asctime)s] %(levelname)s: %(message)s')
+
+    with tempfile.TemporaryDirectory(prefix='logparser-bench-') as tmp_dir:
+        results = run(args, Path(tmp_dir))
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import gzip
+import io
+import logging
+import lzma
+import queue
+import shutil
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+# external commands which (de)compress using multiple threads, in the order of preference
+COMMANDS = {
+    '.gz': [
+        (['pigz', '-c'], ['pigz', '-dc'])
+    ],
+    '.xz': [
+        (['xz', '-T0', '-c'], ['xz', '-T0', '-dc'])
+    ],
+    '.zst': [
+        (['zstd', '-T0', '-q', '-c'], ['zstd', '-q', '-dc'])
+    ]
+}
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def open_compressed_file(path, mode, encoding=None):
+    # open a compressed file using an external command, if it is available, or
+    # using the python module in a background thread, in both cases the (de)compression
+    # runs in parallel to the parsing
+    for compress_command, decompress_command in COMMANDS.get(path.suffix, []):
+        if shutil.which(compress_command[0]):
+            if mode.startswith('r'):
+                raw = ProcessStream(subprocess.Popen([*decompress_command, str(path)], stdout=subprocess.PIPE))
+            else:
+                with open(path, 'ab' if mode.startswith('a') else 'wb') as fp:
+                    raw = ProcessStream(subprocess.Popen(compress_command, stdin=subprocess.PIPE, stdout=fp))
+            break
+    else:
+        fileobj = open_module_file(path, 'rb' if mode.startswith('r') else mode[0] + 'b')
+        raw = ThreadedReader(fileobj) if mode.startswith('r') else ThreadedWriter(fileobj)
+
+    if mode.startswith('r'):
+        fp = io.BufferedReader(raw, BLOCK_SIZE)
+    else:
+        fp = io.BufferedWriter(raw, BLOCK_SIZE)
+
+    return fp if 'b' in mode else io.TextIOWrapper(fp, encoding=encoding)
+
+
+def open_module_file(path, mode):
+    if path.suffix == '.gz':
+        return gzip.open(path, mode)
+    elif path.suffix == '.xz':
+        return lzma.open(path, mode)
+    elif path.suffix == '.zst':
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError('For .zst files, either zstd or the zstandard package needs to be installed') from e
+
+        return zstandard.open(path, mode)
+    else:
+        raise RuntimeError(f'{path.suffix} is not a supported compression')
+
+
+class ProcessStream(io.RawIOBase):
+    # reads from the stdout or writes to the stdin of an external process
+
+    def __init__(self, process):
+        self.process = process
+        self.stream = process.stdout or process.stdin
+        self.eof = False
+
+    def readable(self):
+        return self.stream is self.process.stdout
+
+    def writable(self):
+        return self.stream is self.process.stdin
+
+    def readinto(self, b):
+        size = self.stream.readinto(b)
+        if size == 0 and len(b):
+            self.eof = True
+        return size
+
+    def write(self, b):
+        return self.stream.write(b)
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.stream.close()
+
+            # a reading process which is closed before the end of its output is terminated, its exit status
+            # is ignored, since it might also have been killed by SIGPIPE when stdout was closed
+            if self.readable() and not self.eof:
+                if self.process.poll() is None:
+                    self.process.terminate()
+                self.process.wait()
+            elif self.process.wait():
+                raise OSError(f'{self.process.args[0]} exited with {self.process.returncode}')
+
+
+class ThreadedReader(io.RawIOBase):
+    # reads blocks from the file object in a background thread,
+    # decompression with gzip or lzma releases the GIL while it runs
+
+    def __init__(self, fileobj, maxsize=16):
+        self.fileobj = fileobj
+        self.queue = queue.Queue(maxsize)
+        self.block = memoryview(b'')
+        self.eof = False
+        self.error = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def readable(self):
+        return True
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                data = self.fileobj.read(BLOCK_SIZE)
+                self.queue.put(data)
+                if not data:
+                    break
+        except Exception as e:
+            self.error = e
+            self.queue.put(b'')
+
+    def readinto(self, b):
+        if not self.block:
+            if self.eof:
+                return 0
+
+            self.block = memoryview(self.queue.get())
+            if self.error:
+                raise self.error
+            if not self.block:
+                self.eof = True
+                return 0
+
+        size = min(len(b), len(self.block))
+        b[:size] = self.block[:size]
+        self.block = self.block[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            super().close()
+
+            # stop the thread and empty the queue, so that the thread is not blocked
+            self.stopped.set()
+            while self.thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+            self.fileobj.close()
+
+
+class ThreadedWriter(io.RawIOBase):
+    # writes blocks to the file object in a background thread,
+    # compression with gzip or lzma releases the GIL while it runs
+
+    def __init__(self, fileobj, maxsize=16):
+        self.fileobj = fileobj
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def writable(self):
+        return True
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+
+            # after an error, the queue is still emptied, so that write does not block
+            if self.error is None:
+                try:
+                    self.fileobj.write(data)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, b):
+        if self.error:
+            raise self.error
+
+        self.queue.put(bytes(b))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.queue.put(None)
+            self.thread.join()
+            self.fileobj.close()
+
+            if self.error:
+                raise self.error
@@ -1,13 +1,46 @@
-from sqlalchemy import BigInteger, Column, DateTime, Integer, String, Text, column, create_engine, func
+import io
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Float,
+    Index,
+    Integer,
+    LargeBinary,
+    MetaData,
+    PrimaryKeyConstraint,
+    String,
+    Table,
+    Text,
+    and_,
+    create_engine,
+    insert,
+    inspect,
+    make_url,
+    select,
+    text,
+    update,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 Base = declarative_base()
 
+mysql_char_fields = ['host', 'remote_user', 'request_path', 'request_query', 'referrer_scheme', 'referrer_host',
+                     'referrer_path', 'referrer_query', 'user_agent', 'user_agent_device', 'user_agent_os',
+                     'user_agent_browser', 'upstream_addr']
+
 
 class Record(Base):
 
     __tablename__ = 'records'
+    __table_args__ = (
+        Index('ix_records_sha1', 'sha1', unique=True),
+        Index('ix_records_time', 'time'),
+        Index('ix_records_host_time', 'host', 'time')
+    )
 
     id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
     sha1 = Column(Text().with_variant(String(40), 'mysql'), nullable=False)
@@ -30,22 +63,260 @@ class Record(Base):
     user_agent_device = Column(Text().with_variant(String(384), 'mysql'))
     user_agent_os = Column(Text().with_variant(String(384), 'mysql'))
     user_agent_browser = Column(Text().with_variant(String(384), 'mysql'))
+    request_time = Column(Float)
+    upstream_addr = Column(Text().with_variant(String(384), 'mysql'))
+    upstream_response_time = Column(Float)
 
     def __repr__(self):
         return str(self.id)
 
 
-def create_session(database_settings):
+class RollupRecord(Base):
+
+    __tablename__ = 'rollups'
+    __table_args__ = (
+        Index('ix_rollups_bucket', 'period', 'bucket'),
+    )
+
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    period = Column(Text().with_variant(String(8), 'mysql'), nullable=False)
+    bucket = Column(DateTime, nullable=False)
+    dimensions = Column(Text().with_variant(String(384), 'mysql'), nullable=False)
+    host = Column(Text().with_variant(String(384), 'mysql'))
+    remote_country = Column(Text().with_variant(String(2), 'mysql'))
+    request_method = Column(Text().with_variant(String(16), 'mysql'))
+    request_path = Column(Text().with_variant(String(384), 'mysql'))
+    status = Column(Integer)
+    referrer_host = Column(Text().with_variant(String(384), 'mysql'))
+    user_agent_device = Column(Text().with_variant(String(384), 'mysql'))
+    user_agent_os = Column(Text().with_variant(String(384), 'mysql'))
+    user_agent_browser = Column(Text().with_variant(String(384), 'mysql'))
+    count = Column(BigInteger, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    unique_remote_hosts = Column(BigInteger)
+    sketch = Column(LargeBinary)
+
+    def __repr__(self):
+        return str(self.id)
+
+
+def get_partitioned_table():
+    # for postgresql, the records table can be partitioned by month, the primary key and the unique index
+    # of a partitioned table have to include the partition key, i.e. the time
+    columns = [
+        Column('id', BigInteger, autoincrement=True),
+        *(Column(column.name, column.type, nullable=column.nullable)
+          for column in Record.__table__.columns if column.name != 'id')
+    ]
+
+    return Table('records', MetaData(), *columns,
+                 PrimaryKeyConstraint('id', 'time'),
+                 Index('ix_records_sha1', 'sha1', 'time', unique=True),
+                 Index('ix_records_time', 'time'),
+                 Index('ix_records_host_time', 'host', 'time'),
+                 postgresql_partition_by='RANGE (time)')
+
+
+def create_database(database_settings, partition=False):
     if database_settings is None:
         raise RuntimeError('No database connection available')
 
     engine = create_engine(database_settings)
+    with engine.begin() as connection:
+        create_tables(connection, partition)
+
+    return engine
+
+
+async def create_async_database(database_settings, partition=False):
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    engine = create_async_engine(database_settings)
+    async with engine.begin() as connection:
+        await connection.run_sync(create_tables, partition)
+
+    return engine
+
+
+def is_async_database(database_settings):
+    # e.g. postgresql+asyncpg:// or sqlite+aiosqlite://
+    if database_settings is None:
+        raise RuntimeError('No database connection available')
+
+    return make_url(database_settings).get_dialect().is_async
+
+
+def create_tables(connection, partition=False):
+    if partition:
+        if connection.dialect.name != 'postgresql':
+            raise RuntimeError('Partitioning is only supported for PostgreSQL')
+
+        get_partitioned_table().create(connection, checkfirst=True)
+        if connection.execute(text("SELECT relkind FROM pg_class WHERE oid = 'records'::regclass")).scalar() != 'p':
+            raise RuntimeError('The records table already exists and is not partitioned')
+
+    Base.metadata.create_all(connection)
 
-    Base.metadata.create_all(engine)
+    # tables created by older versions lack the columns for the fields which were added later
+    columns = {column['name'] for column in inspect(connection).get_columns(Record.__tablename__)}
+    for column in Record.__table__.columns:
+        if column.name not in columns:
+            connection.execute(text(f'ALTER TABLE {Record.__tablename__} '
+                                    f'ADD COLUMN {column.name} {column.type.compile(connection.dialect)}'))
 
-    Session = sessionmaker(bind=engine)
+    # tables created by older versions lack the indexes used for deduplication and time ranges,
+    # for partitioned tables, the indexes with the same names were created with the table
+    for index in Record.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def create_session(database_settings):
+    Session = sessionmaker(bind=create_database(database_settings))
     return Session()
 
 
 def get_current_records(session, date):
-    return {sha1 for (sha1, ) in session.query(Record).filter(func.DATE(Record.time) == date).values(column('sha1'))}
+    # use a range on time instead of DATE(time), so that the index on time can be used
+    start = datetime.combine(date, datetime.min.time())
+    return set(session.execute(
+        select(Record.sha1).where(Record.time >= start, Record.time < start + timedelta(days=1))
+    ).scalars())
+
+
+def insert_records(engine, log_batch, partitions=None):
+    # insert the rows of a LogBatch, rows with an already existing sha1 are skipped by the database,
+    # for a partitioned table, partitions is the set of the partitions which were already created
+    if not len(log_batch):
+        return
+
+    if partitions is not None:
+        with engine.begin() as connection:
+            create_partitions(connection, log_batch, partitions)
+
+    if engine.dialect.name == 'postgresql' and engine.driver == 'psycopg2':
+        copy_records(engine, log_batch)
+    else:
+        with engine.begin() as connection:
+            connection.execute(get_insert(engine.dialect.name), get_rows(engine.dialect.name, log_batch))
+
+
+async def insert_records_async(engine, log_batch, partitions=None):
+    if not len(log_batch):
+        return
+
+    async with engine.begin() as connection:
+        if partitions is not None:
+            await connection.run_sync(create_partitions, log_batch, partitions)
+
+        await connection.execute(get_insert(engine.dialect.name), get_rows(engine.dialect.name, log_batch))
+
+
+def get_rows(dialect_name, log_batch):
+    rows = [dict(zip(log_batch.fields, row)) for row in log_batch]
+
+    if dialect_name == 'mysql':
+        for row in rows:
+            for field in mysql_char_fields:
+                if row[field]:
+                    row[field] = row[field][:384]
+
+    return rows
+
+
+def get_insert(dialect_name):
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+        return postgresql_insert(Record.__table__).on_conflict_do_nothing()
+    elif dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        return sqlite_insert(Record.__table__).on_conflict_do_nothing()
+    elif dialect_name == 'mysql':
+        return insert(Record.__table__).prefix_with('IGNORE')
+    else:
+        return insert(Record.__table__)
+
+
+def create_partitions(connection, log_batch, partitions):
+    # create the monthly partitions for the times in the batch, the adjacent days are included,
+    # since the times are converted to the timezone of the database session
+    months = set()
+    for day in {time.date() for time in log_batch.get_column('time')}:
+        for date in (day - timedelta(days=1), day, day + timedelta(days=1)):
+            months.add((date.year, date.month))
+
+    for year, month in sorted(months - partitions):
+        start, end = f'{year:04d}-{month:02d}-01', f'{year + month // 12:04d}-{month % 12 + 1:02d}-01'
+        connection.execute(text(f"CREATE TABLE IF NOT EXISTS records_{year:04d}_{month:02d} PARTITION OF records "
+                                f"FOR VALUES FROM ('{start}') TO ('{end}')"))
+        partitions.add((year, month))
+
+
+def insert_rollups(engine, rollup):
+    with engine.begin() as connection:
+        write_rollups(connection, rollup)
+
+
+async def insert_rollups_async(engine, rollup):
+    async with engine.begin() as connection:
+        await connection.run_sync(write_rollups, rollup)
+
+
+def write_rollups(connection, rollup):
+    # add the aggregates of a Rollup to the rollups table, existing rows with the same period, bucket and values
+    # of the dimensions are updated, so that the aggregates of buckets spanning multiple log files are combined
+    from .rollup import HyperLogLog
+
+    table = RollupRecord.__table__
+    dimensions = ','.join(rollup.dimensions)
+
+    for (bucket, *values), count, size, sketch in rollup.rows():
+        if connection.dialect.name == 'mysql':
+            values = [value[:384] if isinstance(value, str) else value for value in values]
+
+        key = {'period': rollup.period, 'bucket': bucket, 'dimensions': dimensions,
+               **dict(zip(rollup.dimensions, values))}
+        condition = and_(*(table.c[name] == value if value is not None else table.c[name].is_(None)
+                           for name, value in key.items()))
+
+        row = connection.execute(select(table.c.id, table.c.sketch).where(condition)).first()
+        if row and sketch and row.sketch:
+            sketch.merge(HyperLogLog(row.sketch))
+
+        values = {'unique_remote_hosts': sketch.count(), 'sketch': sketch.to_bytes()} if sketch else {}
+        if row is None:
+            connection.execute(insert(table).values(count=count, size=size, **values, **key))
+        else:
+            connection.execute(update(table).where(table.c.id == row.id).values(
+                count=table.c.count + count, size=table.c.size + size, **values
+            ))
+
+
+def copy_records(engine, log_batch):
+    # stream the rows into a temporary table using COPY and move them to the records table from there,
+    # since COPY itself can not skip conflicting rows
+    columns = ', '.join(log_batch.fields)
+
+    buffer = io.StringIO()
+    buffer.writelines('\t'.join(map(get_copy_value, row)) + '\n' for row in log_batch)
+    buffer.seek(0)
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f'CREATE TEMPORARY TABLE records_copy ON COMMIT DROP AS '
+                       f'SELECT {columns} FROM records WITH NO DATA')
+        cursor.execute('ALTER TABLE records_copy ALTER COLUMN time TYPE timestamp with time zone')
+        cursor.copy_expert(f'COPY records_copy ({columns}) FROM STDIN', buffer)
+        cursor.execute(f'INSERT INTO records ({columns}) '
+                       f'SELECT {columns} FROM records_copy ON CONFLICT DO NOTHING')
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def get_copy_value(value):
+    # encode a value for the text format of COPY
+    if value is None:
+        return '\\N'
+    else:
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
@@ -0,0 +1,75 @@
+import ipaddress
+import re
+from collections import Counter
+
+from .utils import LRUCache
+
+
+class LogFilter:
+    # compiled version of the --ignore-* options, which is applied by the LogParser
+    # right after the line was matched, before the expensive parts of the parsing
+
+    host_cache_size = 100000
+
+    def __init__(self, hosts=None, methods=None, paths=None, status=None):
+        # hosts containing a / are networks in CIDR notation, all other hosts are prefixes
+        self.host_networks = [ipaddress.ip_network(host, strict=False) for host in hosts or [] if '/' in host]
+        self.host_pattern = self.compile_prefixes(host for host in hosts or [] if '/' not in host)
+        self.host_map = LRUCache(self.host_cache_size)
+
+        self.methods = frozenset(methods or [])
+        self.path_pattern = self.compile_prefixes(paths or [])
+        self.status = frozenset(str(int(status)) for status in status or [])
+
+        self.counts = Counter()
+
+    def __bool__(self):
+        return bool(self.host_networks or self.host_pattern or self.methods or self.path_pattern or self.status)
+
+    @staticmethod
+    def compile_prefixes(prefixes):
+        # combine all prefixes into one regex, longer prefixes first
+        prefixes = sorted(set(prefixes), key=len, reverse=True)
+        if prefixes:
+            return re.compile('|'.join(re.escape(prefix) for prefix in prefixes))
+
+    def ignore_line(self, host, status):
+        if self.status and status in self.status:
+            self.counts['status'] += 1
+            return True
+
+        if (self.host_pattern or self.host_networks) and self.ignore_host(host):
+            self.counts['host'] += 1
+            return True
+
+        return False
+
+    def ignore_request(self, method, path):
+        if self.methods and method in self.methods:
+            self.counts['method'] += 1
+            return True
+
+        if self.path_pattern and path is not None and self.path_pattern.match(path):
+            self.counts['path'] += 1
+            return True
+
+        return False
+
+    def ignore_host(self, host):
+        if self.host_pattern and self.host_pattern.match(host):
+            return True
+
+        if self.host_networks:
+            ignored = self.host_map.lookup(host)
+            if ignored is None:
+                try:
+                    address = ipaddress.ip_address(host)
+                    ignored = any(address in network for network in self.host_networks)
+                except ValueError:
+                    ignored = False
+
+                self.host_map.store(host, ignored)
+
+            return ignored
+
+        return False
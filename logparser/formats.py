@@ -0,0 +1,181 @@
+import re
+
+PRESETS = {
+    'common': '%h %l %u %t "%r" %>s %b',
+    'combined': '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"',
+    'nginx': '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent '
+             '"$http_referer" "$http_user_agent"'
+}
+
+# the groups of LogParser, which are captured for the directives of an Apache LogFormat, together with
+# the factor to convert the value to seconds (only for request_time)
+APACHE_DIRECTIVES = {
+    'h': ('host', None),
+    'a': ('host', None),
+    'u': ('user', None),
+    'r': ('request', None),
+    's': ('status', None),
+    'b': ('size', None),
+    'B': ('size', None),
+    'D': ('request_time', 1e-6),
+    'T': ('request_time', 1),
+    '{s}T': ('request_time', 1),
+    '{ms}T': ('request_time', 1e-3),
+    '{us}T': ('request_time', 1e-6),
+    '{referer}i': ('referrer', None),
+    '{user-agent}i': ('agent', None)
+}
+
+# the same for the variables of a NGINX log_format
+NGINX_VARIABLES = {
+    'remote_addr': ('host', None),
+    'remote_user': ('user', None),
+    'time_local': ('time', None),
+    'time_iso8601': ('time', None),
+    'request': ('request', None),
+    'status': ('status', None),
+    'body_bytes_sent': ('size', None),
+    'http_referer': ('referrer', None),
+    'http_user_agent': ('agent', None),
+    'request_time': ('request_time', 1),
+    'upstream_addr': ('upstream_addr', None),
+    'upstream_response_time': ('upstream_response_time', None)
+}
+
+APACHE_PATTERN = re.compile(r'%[<>]?!?[0-9,]*(?P<argument>\{[^}]*\})?(?P<directive>[a-zA-Z%])')
+
+NGINX_PATTERN = re.compile(r'\$(?:\{(?P<braced>\w+)\}|(?P<variable>\w+))')
+
+# a list of values as logged by NGINX for the upstream variables, e.g. "10.0.0.1:80, 10.0.0.2:80 : 10.0.0.3:80"
+UPSTREAM_PATTERN = r'[^\s,]+(?:(?:,|\s+:)\s+[^\s,]+)*'
+
+# a quoted string, in which quotes are escaped with a backslash, written as an unrolled loop,
+# so that the regex engine does not need to backtrack
+QUOTED_PATTERN = r'[^"\\]*(?:\\.[^"\\]*)*'
+
+
+class Field:
+    # a field of the log format, group is None for fields which are not captured
+
+    def __init__(self, group, scale=None, pattern=None):
+        self.group = group
+        self.scale = scale
+        self.pattern = pattern
+
+
+class LogFormat:
+    # compiles an Apache LogFormat or NGINX log_format spec (or the name of a preset) into two regular expressions
+    # with the groups used by LogParser: pattern does not backtrack and is tried first, fallback_pattern uses greedy
+    # groups (like the fixed pattern, which was used before) and is only tried if pattern does not match
+
+    def __init__(self, spec='combined'):
+        self.spec = PRESETS.get(spec, spec)
+
+        if '$' in self.spec:
+            self.tokens = self.tokenize(NGINX_PATTERN, self.get_nginx_tokens)
+        elif '%' in self.spec:
+            self.tokens = self.tokenize(APACHE_PATTERN, self.get_apache_tokens)
+        else:
+            raise ValueError(f'{spec} is not a log format or one of {", ".join(PRESETS)}')
+
+        self.groups = []
+        self.request_time_scale = None
+        for token in self.tokens:
+            if isinstance(token, Field) and token.group:
+                if token.group in self.groups:
+                    # only the first occurrence is captured, e.g. for %h and %a
+                    token.group = None
+                else:
+                    self.groups.append(token.group)
+                    if token.group == 'request_time':
+                        self.request_time_scale = token.scale
+
+        if 'host' not in self.groups or 'time' not in self.groups:
+            raise ValueError(f'{self.spec} needs to contain at least the remote host and the time')
+
+        self.pattern = re.compile(self.get_pattern(greedy=False))
+        self.fallback_pattern = re.compile(self.get_pattern(greedy=True))
+
+    def __repr__(self):
+        return f'LogFormat({self.spec!r})'
+
+    def match(self, line):
+        return self.pattern.match(line) or self.fallback_pattern.match(line)
+
+    def tokenize(self, pattern, get_tokens):
+        # split the spec into literal strings and fields
+        tokens, position = [], 0
+        for match in pattern.finditer(self.spec):
+            tokens.append(self.spec[position:match.start()])
+            tokens.extend(get_tokens(match))
+            position = match.end()
+        tokens.append(self.spec[position:])
+
+        # merge adjacent literal strings
+        merged_tokens = []
+        for token in tokens:
+            if isinstance(token, str) and merged_tokens and isinstance(merged_tokens[-1], str):
+                merged_tokens[-1] += token
+            elif token != '':
+                merged_tokens.append(token)
+
+        return merged_tokens
+
+    @staticmethod
+    def get_apache_tokens(match):
+        argument, directive = match.group('argument'), match.group('directive')
+        if directive == '%':
+            return ['%']
+        elif directive == 't':
+            if argument:
+                raise ValueError('Custom time formats (%{format}t) are not supported')
+
+            # %t includes the brackets
+            return ['[', Field('time'), ']']
+        else:
+            return [Field(*APACHE_DIRECTIVES.get((argument or '').lower() + directive, (None, )))]
+
+    @staticmethod
+    def get_nginx_tokens(match):
+        variable = match.group('braced') or match.group('variable')
+        if variable == 'time_local':
+            # contains a space, even if it is not enclosed in brackets
+            return [Field('time', pattern=r'[^\s\]]+\s+[+-][0-9]{4}')]
+        elif variable.startswith('upstream_'):
+            # contains spaces if more than one upstream server was used
+            return [Field(*NGINX_VARIABLES.get(variable, (None, )), pattern=UPSTREAM_PATTERN)]
+        else:
+            return [Field(*NGINX_VARIABLES.get(variable, (None, )))]
+
+    def get_pattern(self, greedy):
+        parts = []
+        for index, token in enumerate(self.tokens):
+            if isinstance(token, str):
+                # runs of whitespace match any whitespace, like the fixed pattern used before
+                parts.append(''.join(r'\s+' if part.isspace() else re.escape(part)
+                                     for part in re.split(r'(\s+)', token) if part))
+            else:
+                previous_token = self.tokens[index - 1] if index > 0 else ''
+                next_token = self.tokens[index + 1] if index + 1 < len(self.tokens) else ''
+                pattern = self.get_field_pattern(token, previous_token, next_token, greedy)
+                parts.append(f'(?P<{token.group}>{pattern})' if token.group else f'(?:{pattern})')
+
+        return ''.join(parts) + r'\s*\Z'
+
+    @staticmethod
+    def get_field_pattern(field, previous_token, next_token, greedy):
+        previous_char = previous_token[-1:] if isinstance(previous_token, str) else None
+        next_char = next_token[:1] if isinstance(next_token, str) else None
+
+        if field.pattern:
+            return field.pattern
+        elif field.group == 'status':
+            return r'[0-9]+'
+        elif previous_char == '"' and next_char == '"':
+            return r'.*' if greedy else QUOTED_PATTERN
+        elif previous_char == '[' and next_char == ']':
+            return r'.+' if greedy else r'[^\]]*'
+        elif not next_char or next_char.isspace():
+            return r'\S+'
+        else:
+            return r'.*' if greedy else rf'[^{re.escape(next_char)}]*'
@@ -0,0 +1,83 @@
+import ipaddress
+from pathlib import Path
+
+from .utils import LRUCache
+
+
+class GeoIPIndex:
+    # looks up the countries of IP addresses in a memory-mapped MaxMind database, the results are cached
+    # for the whole network returned by the database, so that the cache grows with the number of networks
+    # and not with the number of distinct addresses
+
+    cache_size = 100000
+
+    def __init__(self, database_path, cache_size=None):
+        import maxminddb
+
+        self.reader = maxminddb.open_database(str(Path(database_path).expanduser()), maxminddb.MODE_MMAP)
+        self.network_map = LRUCache(cache_size or self.cache_size)
+        self.prefix_lengths = {4: [], 6: []}
+
+        # e.g. IPv6 addresses in an IPv4-only database raise a ValueError
+        self.lookup_errors = (ValueError, maxminddb.InvalidDatabaseError)
+
+    def close(self):
+        self.reader.close()
+
+    def lookup(self, host):
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return None
+
+        country, _ = self.lookup_address(address)
+        return country
+
+    def lookup_many(self, hosts):
+        countries, addresses = {}, []
+        for host in set(hosts):
+            try:
+                addresses.append((ipaddress.ip_address(host), host))
+            except ValueError:
+                countries[host] = None
+
+        # walk over the sorted addresses, consecutive addresses in the same network need no further lookup
+        version, end = None, None
+        for address, host in sorted(addresses, key=lambda item: (item[0].version, int(item[0]))):
+            if address.version != version or int(address) >= end:
+                country, (version, prefix_length, prefix) = self.lookup_address(address)
+                end = (prefix + 1) << (address.max_prefixlen - prefix_length)
+
+            countries[host] = country
+
+        return countries
+
+    def lookup_address(self, address):
+        # returns the country and the network of the address, the network is stored as
+        # (version, prefix_length, prefix), where prefix are the first prefix_length bits of the address
+        value, max_prefix_length = int(address), address.max_prefixlen
+
+        for prefix_length in self.prefix_lengths[address.version]:
+            network = (address.version, prefix_length, value >> (max_prefix_length - prefix_length))
+            if network in self.network_map:
+                return self.network_map.lookup(network), network
+
+        self.network_map.misses += 1
+
+        try:
+            record, prefix_length = self.reader.get_with_prefix_len(address)
+        except self.lookup_errors:
+            # the address is stored on its own, without a country
+            record, prefix_length = None, max_prefix_length
+
+        try:
+            country = record['country']['iso_code'].lower()
+        except (AttributeError, KeyError, TypeError):
+            country = None
+
+        network = (address.version, prefix_length, value >> (max_prefix_length - prefix_length))
+        self.network_map.store(network, country)
+        if prefix_length not in self.prefix_lengths[address.version]:
+            self.prefix_lengths[address.version].append(prefix_length)
+
+        return country, network
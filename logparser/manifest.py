@@ -0,0 +1,37 @@
+import logging
+
+from .utils import JsonFile, get_first_line, get_last_line, get_sha1
+
+logger = logging.getLogger(__name__)
+
+
+class Manifest(JsonFile):
+    # records the input files which were processed completely, so that a run over many archived logs only
+    # needs to stat the files, the sha1 of the first and the last line is only read if the mtime changed
+
+    def get_fingerprint(self, input_path):
+        first_line, last_line = get_first_line(input_path), get_last_line(input_path)
+        return [get_sha1(first_line), get_sha1(last_line) if last_line else None]
+
+    def is_done(self, input_path, stat):
+        file_state = self.files.get(str(input_path))
+        if file_state is None or file_state['size'] != stat.st_size:
+            return False
+
+        if file_state['mtime'] == stat.st_mtime:
+            return True
+
+        # the file was touched or copied, compare the content
+        if file_state['fingerprint'] == self.get_fingerprint(input_path):
+            file_state['mtime'] = stat.st_mtime
+            return True
+
+        logger.info('%s was changed', input_path)
+        return False
+
+    def add(self, input_path, stat):
+        self.files[str(input_path)] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'fingerprint': self.get_fingerprint(input_path)
+        }
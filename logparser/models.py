@@ -1,8 +1,23 @@
 import json
-from dataclasses import asdict, dataclass, fields
+import sys
+from dataclasses import dataclass, fields
 from datetime import datetime
+from json.encoder import encode_basestring_ascii
+from operator import attrgetter
 
 
+def add_slots(cls):
+    # re-create a dataclass with __slots__, like dataclass(slots=True) does for Python >= 3.10
+    field_names = tuple(field.name for field in fields(cls))
+    cls_dict = {
+        key: value for key, value in cls.__dict__.items()
+        if key not in (*field_names, '__dict__', '__weakref__')
+    }
+    cls_dict['__slots__'] = field_names
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
+@add_slots
 @dataclass
 class LogEntry:
     sha1: str
@@ -25,13 +40,16 @@ class LogEntry:
     user_agent_device: str
     user_agent_os: str
     user_agent_browser: str
+    request_time: float = None
+    upstream_addr: str = None
+    upstream_response_time: float = None
 
     @classmethod
     def get_fields(cls):
         return [field.name for field in fields(cls)]
 
     def serialize(self):
-        data = asdict(self)
+        data = {field: getattr(self, field) for field in self.__slots__}
         data['time'] = data['time'].isoformat()
         return data
 
@@ -41,3 +59,112 @@ class LogEntry:
     def __post_init__(self):
         if isinstance(self.time, str):
             self.time = datetime.fromisoformat(self.time)
+
+
+class LogBatch:
+    # column-oriented buffer for log entries, which stores one list per field instead of one object per entry,
+    # the strings of the low-cardinality fields are interned, so that each distinct value is stored only once
+
+    interned_fields = ['host', 'remote_country', 'request_method', 'request_version', 'referrer_scheme',
+                       'referrer_host', 'user_agent', 'user_agent_device', 'user_agent_os', 'user_agent_browser']
+
+    def __init__(self):
+        self.fields = LogEntry.get_fields()
+        self.columns = [[] for field in self.fields]
+        self.interned_indexes = [self.fields.index(field) for field in self.interned_fields]
+        self.get_values = attrgetter(*self.fields)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        return zip(*self.columns)
+
+    def __getstate__(self):
+        return self.columns
+
+    def __setstate__(self, columns):
+        self.__init__()
+        for index, (column, values) in enumerate(zip(self.columns, columns)):
+            if index in self.interned_indexes:
+                column.extend(None if value is None else sys.intern(value) for value in values)
+            else:
+                column.extend(values)
+
+    def append(self, log_entry):
+        values = list(self.get_values(log_entry))
+        for index in self.interned_indexes:
+            if values[index] is not None:
+                values[index] = sys.intern(values[index])
+
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def extend(self, log_entries):
+        if isinstance(log_entries, LogBatch):
+            for column, values in zip(self.columns, log_entries.columns):
+                column.extend(values)
+        else:
+            for log_entry in log_entries:
+                self.append(log_entry)
+
+    def get_column(self, field):
+        return self.columns[self.fields.index(field)]
+
+    def entries(self):
+        for values in self:
+            yield LogEntry(*values)
+
+    def get_serialized_columns(self):
+        # the time is converted to isoformat only once for consecutive entries with the same time,
+        # the parser returns the same datetime object for them
+        time_index = self.fields.index('time')
+        times, last_time, last_value = [], None, None
+        for time in self.columns[time_index]:
+            if time is not last_time:
+                last_time, last_value = time, time.isoformat()
+            times.append(last_value)
+
+        columns = list(self.columns)
+        columns[time_index] = times
+        return columns
+
+    def serialize(self):
+        return zip(*self.get_serialized_columns())
+
+    def to_json(self, use_orjson=False):
+        # encode the whole batch at once, column by column, the output is identical to LogEntry.to_json,
+        # orjson is faster, but writes compact json and non-ascii characters as utf-8
+        if use_orjson:
+            import orjson
+
+            return b''.join([
+                orjson.dumps(dict(zip(self.fields, values)), option=orjson.OPT_APPEND_NEWLINE) for values in self
+            ]).decode()
+
+        columns = []
+        for field, column in zip(self.fields, self.get_serialized_columns()):
+            if field in self.interned_fields or field in ['time', 'status']:
+                # encode every distinct value only once
+                values = {value: encode_json_value(value) for value in set(column)}
+                columns.append([values[value] for value in column])
+            else:
+                try:
+                    columns.append(list(map(encode_basestring_ascii, column)))
+                except TypeError:
+                    # the column contains None or numbers
+                    columns.append([encode_json_value(value) for value in column])
+
+        template = '{' + ', '.join(f'"{field}": %s' for field in self.fields) + '}\n'
+        return ''.join([template % values for values in zip(*columns)])
+
+
+def encode_json_value(value):
+    if value is None:
+        return 'null'
+    elif type(value) is str:
+        return encode_basestring_ascii(value)
+    elif type(value) is int:
+        return repr(value)
+    else:
+        return json.dumps(value)
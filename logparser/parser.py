@@ -1,110 +1,253 @@
+import json
 import logging
+import os
 import re
+from collections import Counter
 from datetime import datetime, timedelta
 from pathlib import Path
 from urllib.parse import urlparse
 
 from user_agents import parse
 
+from .filters import LogFilter
+from .formats import LogFormat
+from .geoip import GeoIPIndex
 from .models import LogEntry
-from .utils import get_random_salt, get_sha1
+from .stats import Stats
+from .utils import (
+    LRUCache,
+    get_first_line,
+    get_last_line,
+    get_random_salt,
+    get_sha1,
+    get_tmp_path,
+    parse_clf_time,
+    write_file,
+)
 
 logger = logging.getLogger(__name__)
 
 class LogParser:
-    # Regex for the common Apache log format.
-    # from https://gist.github.com/sumeetpareek/9644255
-    line_parts = [
-        r'(?P<host>\S+)',                   # host %h
-        r'\S+',                             # indent %l (unused)
-        r'(?P<user>\S+)',                   # user %u
-        r'\[(?P<time>.+)\]',                # time %t
-        r'"(?P<request>.*)"',               # request "%r"
-        r'(?P<status>[0-9]+)',              # status %>s
-        r'(?P<size>\S+)',                   # size %b (careful, can be '-')
-        r'"(?P<referrer>.*)"',              # referrer "%{Referer}i"
-        r'"(?P<agent>.*)"',                 # user agent "%{User-agent}i"
-    ]
-    line_pattern = re.compile(r'\s+'.join(line_parts)+r'\s*\Z')
-
     time_format = "%d/%b/%Y:%H:%M:%S %z"
 
     request_pattern = re.compile(r'(?P<method>[A-Z-]+) (?P<request>.*?) HTTP/(?P<http_version>.*)')
 
-    def __init__(self, host='localhost', anon=None, noua=None, salts=None, geoip2_database=None):
+    user_agent_cache_size = 10000
+
+    anon_cache_size = 100000
+
+    def __init__(self, host='localhost', anon=None, noua=None, salts=None,
+                 geoip2_database=None, geoip2_cache_size=None, user_agent_cache_size=None, user_agent_cache=None,
+                 ignore_host=None, ignore_method=None, ignore_path=None, ignore_status=None, stats=False,
+                 log_format=None):
         self.host = host
-        self.host_map = {}
-        self.salt_map = {}
+
+        # the format of the log lines, the name of a preset or an Apache LogFormat or NGINX log_format
+        self.log_format = LogFormat(log_format or 'combined')
+
+        # lines which could not be matched or whose time could not be parsed
+        self.malformed = 0
+
+        # the counts of the ignored lines which were already returned by pop_counts
+        self.ignored_counts = Counter()
+        self.salt_map = LRUCache()
+
+        # the salt for the date of the last line, which is usually the same for the next line
+        self.last_date = None
+        self.last_salt = None
+
+        # the anonymized remote hosts of the current salt, the cache is cleared when the salt changes
+        self.anon_map = LRUCache(self.anon_cache_size)
+        self.anon_salt = None
+
+        # consecutive lines usually share the same time, so the last parsed time is kept
+        self.last_time = None
+        self.last_datetime = None
+
+        # the parsed user agents are cached in memory and optionally persisted in a json file
+        self.user_agent_map = LRUCache(user_agent_cache_size or self.user_agent_cache_size)
+        self.user_agent_cache = Path(user_agent_cache).expanduser() if user_agent_cache else None
+        if self.user_agent_cache and self.user_agent_cache.exists():
+            self.user_agent_map.update(json.loads(self.user_agent_cache.read_text()))
+            while len(self.user_agent_map) > self.user_agent_map.maxsize:
+                self.user_agent_map.popitem(last=False)
 
         self.anon = anon
         self.noua = noua
         self.salts = salts
 
+        self.log_filter = LogFilter(hosts=ignore_host, methods=ignore_method,
+                                    paths=ignore_path, status=ignore_status) or None
+
         if geoip2_database:
-            import geoip2.database
-            geoip2_database = Path(geoip2_database).expanduser()
-            self.geoip2_reader = geoip2.database.Reader(geoip2_database)
+            self.geoip_index = GeoIPIndex(geoip2_database, cache_size=geoip2_cache_size)
+        else:
+            self.geoip_index = None
+
+        # with stats, the stages of the parsing are wrapped to measure their time
+        if stats:
+            self.stats = Stats()
+            self.filter_counts = Counter()
+            for stage in ['match_line', 'parse_time', 'parse_request', 'parse_user_agent',
+                          'get_remote_host', 'get_remote_country', 'get_remote_countries']:
+                setattr(self, stage, self.stats.timed(stage, getattr(self, stage)))
         else:
-            self.geoip2_reader = None
+            self.stats = None
 
     def parse_line(self, line):
-        if line:
-            match = self.line_pattern.match(line)
+        match = self.match_line(line)
+        if match:
+            log_entry = self.parse_match(line, match)
+            if log_entry:
+                log_entry.remote_country = self.get_remote_country(match.group('host'))
+                return log_entry
+        else:
+            self.count_malformed(line)
+
+    def parse_lines(self, lines):
+        # parse a chunk (list) of lines and look up the countries of all remote hosts at once,
+        # returns a list of (log_entry, line) tuples for the lines which could be parsed,
+        # lines read as bytes (see utils.read_log_file) are decoded once and hashed without encoding them again
+        if lines and isinstance(lines[0], bytes):
+            raw_lines, lines = lines, [line.decode() for line in lines]
+        else:
+            raw_lines = lines
+
+        results, remote_hosts = [], []
+        for line, raw_line in zip(lines, raw_lines):
+            match = self.match_line(line)
             if match:
-                time = self.parse_time(match.group('time'))
-                if time:
-                    request = self.parse_request(match.group('request'))
-                    if request:
-                        request_method, request_path, request_query, request_version = request
-
-                        status = self.parse_int(match.group('status'))
-                        size = self.parse_int(match.group('size'))
-
-                        referrer_scheme, referrer_host, referrer_path, referrer_query = \
-                            self.parse_referrer(match.group('referrer'))
-                        user_agent, user_agent_device, user_agent_os, user_agent_browser = \
-                            self.parse_user_agent(match.group('agent'))
-
-                        remote_host = self.get_remote_host(match.group('host'), time, user_agent)
-                        remote_country = self.get_remote_country(match.group('host'))
-                        remote_user = self.get_remote_user(match.group('user'))
-
-                        return LogEntry(
-                            sha1=get_sha1(line),
-                            host=self.host,
-                            remote_host=remote_host,
-                            remote_country=remote_country,
-                            remote_user=remote_user,
-                            time=time,
-                            request_method=request_method,
-                            request_path=request_path,
-                            request_query=request_query,
-                            request_version=request_version,
-                            status=status,
-                            size=size,
-                            referrer_scheme=referrer_scheme,
-                            referrer_host=referrer_host,
-                            referrer_path=referrer_path,
-                            referrer_query=referrer_query,
-                            user_agent=user_agent,
-                            user_agent_device=user_agent_device,
-                            user_agent_os=user_agent_os,
-                            user_agent_browser=user_agent_browser
-                        )
+                log_entry = self.parse_match(raw_line, match)
+                if log_entry:
+                    results.append((log_entry, line))
+                    remote_hosts.append(match.group('host'))
+            else:
+                self.count_malformed(line)
+
+        if self.geoip_index is not None:
+            remote_countries = self.get_remote_countries(remote_hosts)
+            for (log_entry, line), remote_host in zip(results, remote_hosts):
+                log_entry.remote_country = remote_countries[remote_host]
+
+        if self.stats is not None:
+            # the length of the lines is used for the bytes read, which is exact for lines read as bytes
+            self.stats.counts['lines'] += len(lines)
+            self.stats.counts['bytes_read'] += sum(map(len, raw_lines))
+            self.stats.counts['parsed'] += len(results)
+
+        return results
+
+    def match_line(self, line):
+        if line:
+            return self.log_format.match(line)
+
+    def count_malformed(self, line):
+        self.malformed += 1
+        logger.debug('malformed line: %s', line.rstrip())
+
+    def parse_match(self, line, match):
+        # the remote_country is not set here, see parse_line and parse_lines,
+        # the groups which are not part of the log format are None
+        groups = match.groupdict()
+
+        if self.log_filter and self.log_filter.ignore_line(groups['host'], groups.get('status')):
+            return None
+
+        time = self.parse_time(groups['time'])
+        if time:
+            request = self.parse_request(groups.get('request'))
+            if request:
+                request_method, request_path, request_query, request_version = request
+
+                if self.log_filter and self.log_filter.ignore_request(request_method, request_path):
+                    return None
+
+                status = self.parse_int(groups.get('status'))
+                size = self.parse_int(groups.get('size'))
+
+                referrer_scheme, referrer_host, referrer_path, referrer_query = \
+                    self.parse_referrer(groups.get('referrer'))
+                user_agent, user_agent_device, user_agent_os, user_agent_browser = \
+                    self.parse_user_agent(groups.get('agent'))
+
+                remote_host = self.get_remote_host(groups['host'], time, user_agent)
+                remote_user = self.get_remote_user(groups.get('user'))
+
+                return LogEntry(
+                    sha1=get_sha1(line),
+                    host=self.host,
+                    remote_host=remote_host,
+                    remote_country=None,
+                    remote_user=remote_user,
+                    time=time,
+                    request_method=request_method,
+                    request_path=request_path,
+                    request_query=request_query,
+                    request_version=request_version,
+                    status=status,
+                    size=size,
+                    referrer_scheme=referrer_scheme,
+                    referrer_host=referrer_host,
+                    referrer_path=referrer_path,
+                    referrer_query=referrer_query,
+                    user_agent=user_agent,
+                    user_agent_device=user_agent_device,
+                    user_agent_os=user_agent_os,
+                    user_agent_browser=user_agent_browser,
+                    request_time=self.parse_request_time(groups.get('request_time')),
+                    upstream_addr=self.parse_upstream_addr(groups.get('upstream_addr')),
+                    upstream_response_time=self.parse_upstream_response_time(groups.get('upstream_response_time'))
+                )
+        else:
+            self.count_malformed(line)
 
     def parse_time(self, time):
+        if time == self.last_time:
+            return self.last_datetime
+
         try:
-            return datetime.strptime(time, self.time_format)
-        except ValueError:
-            return None
+            parsed_time = parse_clf_time(time)
+        except (KeyError, ValueError):
+            # fall back to strptime for anything which is not exactly in the common log format
+            try:
+                parsed_time = datetime.strptime(time, self.time_format)
+            except ValueError:
+                # e.g. $time_iso8601 of NGINX
+                try:
+                    parsed_time = datetime.fromisoformat(time)
+                except ValueError:
+                    return None
+
+        self.last_time, self.last_datetime = time, parsed_time
+        return parsed_time
 
     def parse_int(self, value):
-        value = value.strip()
-        if value != '-':
-            return int(value)
+        if value is not None:
+            value = value.strip()
+            if value != '-':
+                return int(value)
+
+    def parse_request_time(self, value):
+        try:
+            return float(value) * self.log_format.request_time_scale
+        except (TypeError, ValueError):
+            return None
+
+    def parse_upstream_addr(self, value):
+        if value is not None and value != '-':
+            return value
+
+    def parse_upstream_response_time(self, value):
+        # for multiple upstream servers, NGINX logs the times separated by , and :, they are added up
+        try:
+            times = [float(time) for time in re.split(r'\s*[,:]\s*', value.strip()) if time != '-']
+        except (AttributeError, ValueError):
+            return None
+
+        return sum(times) if times else None
 
     def parse_request(self, request):
-        match = self.request_pattern.match(request)
+        match = self.request_pattern.match(request) if request else None
         if match:
             u = urlparse(match.group('request'))
             return match.group('method'), u.path, u.query, match.group('http_version')
@@ -112,7 +255,7 @@ class LogParser:
             return None, None, None, None
 
     def parse_referrer(self, referrer):
-        referrer = referrer.strip()
+        referrer = referrer.strip() if referrer else '-'
         if referrer != '-':
             u = urlparse(referrer)
             return u.scheme, u.netloc, u.path, u.query
@@ -120,40 +263,102 @@ class LogParser:
             return None, None, None, None
 
     def parse_user_agent(self, agent):
+        if agent is None:
+            return None, None, None, None
+
         agent = agent.strip()
-        parsed_agent = parse(agent)
-        return agent, parsed_agent.get_device(), parsed_agent.get_os(), parsed_agent.get_browser()
+        parsed_agent = self.user_agent_map.lookup(agent)
+        if parsed_agent is None:
+            user_agent = parse(agent)
+            parsed_agent = user_agent.get_device(), user_agent.get_os(), user_agent.get_browser()
+            self.user_agent_map.store(agent, parsed_agent)
+
+        return (agent, *parsed_agent)
 
     def get_remote_host(self, remote_host, time, user_agent):
         if not self.anon:
             return remote_host
-        elif self.noua:
-            return get_sha1(self.get_salt(time) + remote_host)
-        else:
-            return get_sha1(self.get_salt(time) + remote_host + user_agent)
+
+        salt = self.get_salt(time)
+        if salt != self.anon_salt:
+            # the ids of the previous salt period are not needed anymore
+            self.anon_map.clear()
+            self.anon_salt = salt
+
+        value = remote_host if self.noua else remote_host + (user_agent or '')
+        anonymized_host = self.anon_map.lookup(value)
+        if anonymized_host is None:
+            anonymized_host = get_sha1(salt + value)
+            self.anon_map.store(value, anonymized_host)
+
+        return anonymized_host
 
     def get_remote_country(self, remote_host):
-        if self.geoip2_reader is None:
+        if self.geoip_index is None:
             return None
 
-        from geoip2.errors import AddressNotFoundError
-
-        if remote_host in self.host_map:
-            return self.host_map[remote_host]
-        else:
-            try:
-                country_response = self.geoip2_reader.country(remote_host)
-                self.host_map[remote_host] = country_response.country.iso_code.lower()
-            except (AddressNotFoundError, AttributeError, ValueError):
-                self.host_map[remote_host] = None
+        return self.geoip_index.lookup(remote_host)
 
-            return self.host_map[remote_host]
+    def get_remote_countries(self, remote_hosts):
+        return self.geoip_index.lookup_many(remote_hosts)
 
     def get_remote_user(self, user):
         return user if self.anon is None else None
 
+    def pop_stats(self):
+        # return the stats collected since the last call, including the caches and filters
+        if self.stats is None:
+            return None
+
+        self.stats.add_cache('user_agent_cache', self.user_agent_map)
+        self.stats.add_cache('salt_cache', self.salt_map)
+        self.stats.add_cache('anon_cache', self.anon_map)
+        if self.geoip_index is not None:
+            self.stats.add_cache('geoip2_cache', self.geoip_index.network_map)
+
+        if self.log_filter:
+            self.stats.add_cache('ignore_host_cache', self.log_filter.host_map)
+            for rule, count in (self.log_filter.counts - self.filter_counts).items():
+                self.stats.counts['filtered'] += count
+                self.stats.counts[f'filtered_{rule}'] += count
+            self.filter_counts = self.log_filter.counts.copy()
+
+        return self.stats.pop()
+
+    def pop_counts(self):
+        # return the number of malformed and ignored lines since the last call, so that the counts
+        # of the workers can be added up in the main process
+        counts = Counter(malformed=self.malformed)
+        self.malformed = 0
+
+        if self.log_filter:
+            for rule, count in (self.log_filter.counts - self.ignored_counts).items():
+                counts[f'ignored_{rule}'] += count
+            self.ignored_counts = self.log_filter.counts.copy()
+
+        return counts
+
+    def close(self):
+        if self.geoip_index is not None:
+            self.geoip_index.close()
+
+        if self.user_agent_cache:
+            self.save_user_agent_cache()
+
+    def save_user_agent_cache(self):
+        # merge with the entries stored by other processes and replace the file atomically
+        user_agent_map = LRUCache(self.user_agent_map.maxsize)
+        if self.user_agent_cache.exists():
+            user_agent_map.update(json.loads(self.user_agent_cache.read_text()))
+        for agent, parsed_agent in self.user_agent_map.items():
+            user_agent_map.store(agent, parsed_agent)
+
+        write_file(self.user_agent_cache, json.dumps(user_agent_map))
+
     def get_salt(self, time):
         date = time.date()
+        if date == self.last_date:
+            return self.last_salt
 
         if self.anon == 'daily':
             salt_date = date
@@ -166,16 +371,43 @@ class LogParser:
         else:
             raise RuntimeError('anon must be one of (daily, weekly, monthly, eternally)')
 
-        salt = self.salt_map.get(salt_date)
+        salt = self.salt_map.lookup(salt_date)
         if salt is None:
             salt_path = Path(self.salts).expanduser() / str(salt_date)
-            if salt_path.exists():
-                salt = salt_path.read_text()
-            else:
-                salt = get_random_salt()
+            if not salt_path.exists():
+                # write the new salt to a temporary file and link it to the salt_path, so that
+                # parallel workers never read a partial salt and agree on the first one created
                 salt_path.parent.mkdir(exist_ok=True, parents=True)
-                salt_path.write_text(salt)
+                tmp_path = get_tmp_path(salt_path)
+                tmp_path.write_text(get_random_salt())
+                try:
+                    os.link(tmp_path, salt_path)
+                except FileExistsError:
+                    pass
+                finally:
+                    tmp_path.unlink()
+
+            salt = salt_path.read_text()
 
-            self.salt_map[salt_date] = salt
+            self.salt_map.store(salt_date, salt)
 
+        self.last_date, self.last_salt = date, salt
         return salt
+
+    def preload_salts(self, input_path):
+        # read (or create) the salts for all dates between the first and the last line of a log file
+        # before it is parsed, the last line can not be read from compressed files
+        if not self.anon:
+            return
+
+        times = []
+        for line in [get_first_line(input_path), get_last_line(input_path)]:
+            match = self.log_format.match(line) if line else None
+            time = self.parse_time(match.group('time')) if match else None
+            if time:
+                times.append(time)
+
+        if times:
+            first_time, last_time = min(times), max(times)
+            for days in range((last_time.date() - first_time.date()).days + 1):
+                self.get_salt(first_time + timedelta(days=days))
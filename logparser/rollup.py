@@ -0,0 +1,174 @@
+import hashlib
+import math
+from collections import Counter
+
+from .models import LogBatch, encode_json_value
+
+DIMENSIONS = ['host', 'remote_country', 'request_method', 'request_path', 'status', 'referrer_host',
+              'user_agent_device', 'user_agent_os', 'user_agent_browser']
+
+PERIODS = ['hour', 'day', 'month']
+
+
+class Rollup:
+    # aggregates log entries into counts (and the sum of the sizes) per time bucket and the values of the dimensions,
+    # optionally with the number of unique remote hosts, estimated using a HyperLogLog sketch for every row
+
+    def __init__(self, dimensions, period='day', unique=False):
+        self.dimensions = list(dimensions)
+        self.period = period
+        self.unique = unique
+
+        self.fields = ['bucket', *self.dimensions, 'count', 'size']
+        if self.unique:
+            self.fields.append('unique_remote_hosts')
+
+        self.counts = Counter()
+        self.sizes = Counter()
+        self.sketches = {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def append(self, log_entry):
+        self.extend([log_entry])
+
+    def extend(self, log_entries):
+        if not isinstance(log_entries, LogBatch):
+            log_batch = LogBatch()
+            log_batch.extend(log_entries)
+        else:
+            log_batch = log_entries
+
+        keys = list(zip(self.get_buckets(log_batch.get_column('time')),
+                        *map(log_batch.get_column, self.dimensions)))
+
+        self.counts.update(keys)
+        for key, size in zip(keys, log_batch.get_column('size')):
+            if size:
+                self.sizes[key] += size
+
+        if self.unique:
+            for key, remote_host in set(zip(keys, log_batch.get_column('remote_host'))):
+                if key not in self.sketches:
+                    self.sketches[key] = HyperLogLog()
+                self.sketches[key].add(remote_host)
+
+    def get_buckets(self, times):
+        # truncate the times in their own timezone, consecutive entries share the same datetime object
+        buckets, last_time, last_bucket = [], None, None
+        for time in times:
+            if time is not last_time:
+                if self.period == 'hour':
+                    last_bucket = time.replace(minute=0, second=0, microsecond=0)
+                elif self.period == 'day':
+                    last_bucket = time.replace(hour=0, minute=0, second=0, microsecond=0)
+                else:
+                    last_bucket = time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+                last_time = time
+            buckets.append(last_bucket)
+
+        return buckets
+
+    def rows(self):
+        # yields the key, count, size and sketch of every aggregate, ordered by bucket
+        for key in sorted(self.counts, key=lambda key: (key[0], tuple(map(str, key[1:])))):
+            yield key, self.counts[key], self.sizes[key], self.sketches.get(key)
+
+    def serialize(self):
+        for (bucket, *values), count, size, sketch in self.rows():
+            row = [bucket.isoformat(), *values, count, size]
+            if self.unique:
+                row.append(sketch.count())
+            yield row
+
+    def to_json(self, use_orjson=False):
+        if use_orjson:
+            import orjson
+
+            return b''.join([
+                orjson.dumps(dict(zip(self.fields, row)), option=orjson.OPT_APPEND_NEWLINE)
+                for row in self.serialize()
+            ]).decode()
+
+        return ''.join([
+            '{' + ', '.join(f'"{field}": {encode_json_value(value)}'
+                            for field, value in zip(self.fields, row)) + '}\n'
+            for row in self.serialize()
+        ])
+
+
+class HyperLogLog:
+    # estimates the number of distinct values using 2 ** precision registers of one byte,
+    # the standard error is about 1.04 / sqrt(2 ** precision), i.e. 1.6% for the default precision,
+    # small sketches only store the registers which are set and are stored as 3 bytes per register
+
+    precision = 12
+
+    def __init__(self, data=None):
+        self.sparse = {}
+        self.registers = None
+
+        if data and len(data) == 1 << self.precision:
+            self.registers = bytearray(data)
+        elif data:
+            for i in range(0, len(data), 3):
+                self.sparse[int.from_bytes(data[i:i + 2], 'big')] = data[i + 2]
+
+    def add(self, value):
+        x = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+        # the first bits select the register, which stores the maximum position of the first 1 bit in the others
+        bits = 64 - self.precision
+        index, rank = x >> bits, bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        self.set_register(index, rank)
+
+    def set_register(self, index, rank):
+        if self.registers is not None:
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+
+            # the dict uses about as much memory as the dense registers when 1/32 of the registers are set
+            if len(self.sparse) > (1 << self.precision) // 32:
+                self.registers = bytearray(1 << self.precision)
+                for sparse_index, sparse_rank in self.sparse.items():
+                    self.registers[sparse_index] = sparse_rank
+                self.sparse = {}
+
+    def merge(self, other):
+        if other.registers is None:
+            for index, rank in other.sparse.items():
+                self.set_register(index, rank)
+        elif self.registers is None:
+            sparse = self.sparse
+            self.registers, self.sparse = bytearray(other.registers), {}
+            for index, rank in sparse.items():
+                self.set_register(index, rank)
+        else:
+            self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def to_bytes(self):
+        if self.registers is not None:
+            return bytes(self.registers)
+
+        return b''.join(index.to_bytes(2, 'big') + bytes([rank]) for index, rank in sorted(self.sparse.items()))
+
+    def count(self):
+        m = 1 << self.precision
+        if self.registers is not None:
+            zeros = self.registers.count(0)
+            total = sum(2.0 ** -register for register in self.registers)
+        else:
+            zeros = m - len(self.sparse)
+            total = zeros + sum(2.0 ** -rank for rank in self.sparse.values())
+
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / total
+
+        # use linear counting for small cardinalities
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+
+        return round(estimate)
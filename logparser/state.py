@@ -0,0 +1,94 @@
+import logging
+import os
+
+from .utils import JsonFile, get_first_line, get_sha1, normalize_line, open_log_file
+
+logger = logging.getLogger(__name__)
+
+
+class State(JsonFile):
+    # keeps track of how far each log file was read, the files are identified by the sha1 of their
+    # first line, so that they are recognized after they were renamed (or compressed) by logrotate
+
+    def __init__(self, path):
+        super().__init__(path)
+
+        # the offsets of the files which were read, but whose output was not written yet
+        self.pending = {}
+
+    def get_fingerprint(self, input_path):
+        first_line = get_first_line(input_path)
+        if first_line.endswith('\n'):
+            return get_sha1(first_line)
+
+    def get_offset(self, input_path, fingerprint, stat):
+        file_state = self.files.get(fingerprint)
+        if file_state is None:
+            return 0
+
+        if file_state['path'] != str(input_path):
+            logger.info('%s was rotated to %s', file_state['path'], input_path)
+
+        if (file_state['inode'], file_state['size'], file_state['mtime']) == \
+                (stat.st_ino, stat.st_size, stat.st_mtime):
+            # the file did not change since the last run
+            return None
+
+        if file_state['inode'] == stat.st_ino and stat.st_size < file_state['size']:
+            # the file was truncated (e.g. by copytruncate) and written again with the same first line
+            logger.info('%s was truncated', input_path)
+            return 0
+
+        return file_state['offset']
+
+    def set_offset(self, input_path, fingerprint, stat, offset):
+        self.pending[str(input_path)] = fingerprint, {
+            'path': str(input_path),
+            'inode': stat.st_ino,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'offset': offset
+        }
+
+    def commit(self, input_path):
+        # store the offset of a file after its output was written completely
+        if str(input_path) in self.pending:
+            fingerprint, file_state = self.pending.pop(str(input_path))
+            self.files[fingerprint] = file_state
+
+    def read_lines(self, input_path):
+        # yield the complete lines, which were added to the file since the last run
+        fingerprint = self.get_fingerprint(input_path)
+        if fingerprint is None:
+            return
+
+        stat = os.stat(input_path)
+        offset = self.get_offset(input_path, fingerprint, stat)
+        if offset is None:
+            return
+
+        logger.info('read %s from offset %s', input_path, offset)
+
+        with open_log_file(input_path, 'rb', log=False) as fp:
+            if fp.seekable():
+                fp.seek(offset)
+            else:
+                # files read from an external process can not seek, the offset is skipped by reading
+                remaining = offset
+                while remaining > 0:
+                    data = fp.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        break
+                    remaining -= len(data)
+
+            for line in fp:
+                # a line without newline is still being written, it is read again on the next run
+                if not line.endswith(b'\n'):
+                    break
+
+                offset += len(line)
+
+                # the lines are passed to the parser as bytes, like utils.read_log_file does
+                yield normalize_line(line)
+
+        self.set_offset(input_path, fingerprint, stat, offset)
@@ -0,0 +1,117 @@
+import json
+import logging
+from collections import Counter
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+
+from .utils import write_file
+
+logger = logging.getLogger(__name__)
+
+
+class Stats:
+    # counters and timings collected by LogParser and Writer when --stats is used,
+    # when it is not used, no methods are wrapped and no counters are updated
+
+    caches = ['user_agent_cache', 'salt_cache', 'anon_cache', 'geoip2_cache', 'ignore_host_cache']
+
+    def __init__(self):
+        self.counts = Counter()
+        self.times = Counter()
+
+    def timed(self, stage, function):
+        times = self.times
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                times[stage] += perf_counter() - start
+
+        return wrapper
+
+    def add_cache(self, name, cache):
+        # move the hits and misses of an LRUCache to the counters
+        self.counts[f'{name}_hits'] += cache.hits
+        self.counts[f'{name}_misses'] += cache.misses
+        cache.hits = cache.misses = 0
+
+    def pop(self):
+        # return the collected stats and reset this object
+        stats = Stats()
+        stats.merge(self)
+        self.counts.clear()
+        self.times.clear()
+        return stats
+
+    def merge(self, stats):
+        if stats is not None:
+            self.counts.update(stats.counts)
+            self.times.update(stats.times)
+
+    def to_dict(self):
+        counts = dict(self.counts)
+        counts['unmatched'] = counts.get('lines', 0) - counts.get('parsed', 0) - counts.get('filtered', 0)
+
+        cache_ratios = {}
+        for cache in self.caches:
+            hits, misses = self.counts[f'{cache}_hits'], self.counts[f'{cache}_misses']
+            if hits + misses:
+                cache_ratios[cache] = round(hits / (hits + misses), 4)
+
+        return {
+            'counts': counts,
+            'times': {stage: round(seconds, 6) for stage, seconds in self.times.items()},
+            'cache_ratios': cache_ratios
+        }
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        lines = []
+        for name, value in sorted(data['counts'].items()):
+            lines.append(f'# TYPE logparser_{name}_total counter')
+            lines.append(f'logparser_{name}_total {value}')
+
+        lines.append('# TYPE logparser_stage_seconds_total counter')
+        for stage, seconds in sorted(data['times'].items()):
+            lines.append(f'logparser_stage_seconds_total{{stage="{stage}"}} {seconds}')
+
+        lines.append('# TYPE logparser_cache_hit_ratio gauge')
+        for cache, ratio in sorted(data['cache_ratios'].items()):
+            lines.append(f'logparser_cache_hit_ratio{{cache="{cache}"}} {ratio}')
+
+        return '\n'.join(lines) + '\n'
+
+    def log(self, name):
+        data = self.to_dict()
+        counts = data['counts']
+        logger.info('%s: %s lines, %s parsed, %s filtered, %s unmatched, %s bytes read, %s bytes written', name,
+                    counts.get('lines', 0), counts.get('parsed', 0), counts.get('filtered', 0),
+                    counts['unmatched'], counts.get('bytes_read', 0), counts.get('bytes_written', 0))
+        if data['times']:
+            logger.info('%s: %s', name, ', '.join(
+                f'{stage} {seconds:.3f}s' for stage, seconds in sorted(data['times'].items())
+            ))
+        if data['cache_ratios']:
+            logger.info('%s: %s', name, ', '.join(
+                f'{cache} {ratio:.1%} hits' for cache, ratio in sorted(data['cache_ratios'].items())
+            ))
+
+
+def dump_stats(path, file_stats, total_stats):
+    # write the stats as json or, if the path ends with .prom, in the textfile format of prometheus
+    path = Path(path).expanduser()
+
+    if path.suffix == '.prom':
+        content = total_stats.to_prometheus()
+    else:
+        content = json.dumps({
+            'files': {input_path: stats.to_dict() for input_path, stats in file_stats.items()},
+            'total': total_stats.to_dict()
+        }, indent=2)
+
+    # replace the file atomically, since it might be read by the node exporter at any time
+    write_file(path, content)
@@ -1,17 +1,27 @@
 import gzip
 import hashlib
+import json
 import logging
 import lzma
 import os
 import secrets
 import string
 import sys
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
 
-def open_log_file(log_path, mode='rt', log=True):
+TIMEZONES = {}
+
+
+def open_log_file(log_path, mode='rt', log=True, parallel=False):
     if log_path is None:
         return sys.stdout
 
@@ -20,14 +30,18 @@ def open_log_file(log_path, mode='rt', log=True):
 
     log_path = Path(log_path)
 
-    if mode.startswith('w'):
+    if mode.startswith(('w', 'a')):
         log_path.parent.mkdir(exist_ok=True, parents=True)
 
     kwargs = {}
     if 'b' not in mode:
         kwargs['encoding'] = 'utf-8'
 
-    if log_path.suffix == '.gz':
+    if log_path.suffix == '.zst' or (parallel and log_path.suffix in ['.gz', '.xz']):
+        # (de)compress in an external process or a background thread
+        from .compression import open_compressed_file
+        return open_compressed_file(log_path, mode, **kwargs)
+    elif log_path.suffix == '.gz':
         return gzip.open(log_path, mode, **kwargs)
     elif log_path.suffix == '.xz':
         return lzma.open(log_path, mode, **kwargs)
@@ -35,18 +49,87 @@ def open_log_file(log_path, mode='rt', log=True):
         return open(log_path, mode, **kwargs)
 
 
-def get_output_path(input_path, output_base_path, output_format=None):
+def get_output_path(input_path, output_base_path, output_format=None, rollup=False):
     output_path = Path(output_base_path) / Path(input_path).name
     if output_format is None:
         return output_path
-    elif output_format in ['json', 'json.gz', 'json.xz', 'csv', 'csv.gz', 'csv.xz']:
-        return output_path.with_suffix(f'.{output_format}')
+    elif output_format in ['json', 'json.gz', 'json.xz', 'json.zst', 'csv', 'csv.gz', 'csv.xz', 'csv.zst',
+                           'parquet', 'arrow']:
+        return output_path.with_suffix(f'.rollup.{output_format}' if rollup else f'.{output_format}')
     else:
         return None
 
 
+def get_tmp_path(path):
+    # a temporary file next to path, the name keeps the suffix, so that it is compressed the same way
+    return path.with_name(f'.{os.getpid()}.{path.name}')
+
+
+def write_file(path, content):
+    # write the file to a temporary file first and replace it, so that it is never read partially
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = get_tmp_path(path)
+    try:
+        tmp_path.write_text(content)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+class JsonFile:
+    # a dict of the files which were processed, which is loaded from a json file and saved atomically
+
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self.files = json.loads(self.path.read_text()) if self.path.exists() else {}
+
+    def save(self):
+        write_file(self.path, json.dumps(self.files, indent=2))
+
+
+def parse_clf_time(time):
+    # parse the fixed layout of the common log format, e.g. 10/Oct/2000:13:55:36 -0700,
+    # raises a ValueError (or KeyError) if time does not match this layout exactly
+    if len(time) != 26 or time[2] != '/' or time[6] != '/' or time[11] != ':' or time[14] != ':' \
+            or time[17] != ':' or time[20] != ' ' or time[21] not in '+-':
+        raise ValueError(f'{time} does not match the common log format')
+
+    digits = time[0:2] + time[7:11] + time[12:14] + time[15:17] + time[18:20] + time[22:26]
+    if not (digits.isascii() and digits.isdigit()):
+        raise ValueError(f'{time} does not match the common log format')
+
+    offset = time[21:26]
+    tzinfo = TIMEZONES.get(offset)
+    if tzinfo is None:
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+        tzinfo = TIMEZONES[offset] = timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes))
+
+    return datetime(int(time[7:11]), MONTHS[time[3:6]], int(time[0:2]),
+                    int(time[12:14]), int(time[15:17]), int(time[18:20]), tzinfo=tzinfo)
+
+
 def get_sha1(string):
-    return hashlib.sha1(string.encode()).hexdigest()
+    return hashlib.sha1(string if isinstance(string, bytes) else string.encode()).hexdigest()
+
+
+def read_log_file(log_path):
+    # yield the lines of an uncompressed log file as bytes, a file which is truncated while it is read
+    # just ends early
+    logger.info('read %s', log_path)
+
+    with open(log_path, 'rb') as fp:
+        yield from read_lines(fp)
+
+
+def read_lines(fp):
+    # yield the lines of a file opened in binary mode, which are passed to the parser as bytes
+    for line in fp:
+        yield normalize_line(line)
+
+
+def normalize_line(line):
+    # replace \r\n by \n, like open_log_file does in text mode, so that the lines of all inputs are hashed the same
+    return line[:-2] + b'\n' if line.endswith(b'\r\n') else line
 
 
 def get_random_salt():
@@ -60,11 +143,42 @@ def get_first_line(path):
 
 
 def get_last_line(path):
+    # compressed files would need to be decompressed completely to find the last line
+    if Path(path).suffix in ['.gz', '.xz', '.zst']:
+        return None
+
     try:
         with open_log_file(path, 'rb', log=False) as fp:
             fp.seek(-2, os.SEEK_END)
             while fp.read(1) != b'\n':
                 fp.seek(-2, os.SEEK_CUR)
             return fp.readline().decode()
-    except (OSError, FileNotFoundError):
+    except OSError:
+        # the file is empty or has only one line
         return None
+
+
+class LRUCache(OrderedDict):
+
+    def __init__(self, maxsize=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        try:
+            value = self[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.move_to_end(key)
+        return value
+
+    def store(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        if self.maxsize is not None and len(self) > self.maxsize:
+            self.popitem(last=False)
@@ -0,0 +1,105 @@
+import io
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing.util import Finalize
+from pathlib import Path
+
+from .models import LogBatch
+from .parser import LogParser
+from .utils import open_log_file, read_lines
+
+logger = logging.getLogger(__name__)
+
+# size of the byte ranges uncompressed files are split into
+SHARD_SIZE = 16 * 1024 * 1024
+
+# the parser and arguments of the worker process, set by init_worker
+worker_parser = None
+worker_args = None
+
+
+def init_worker(parser_kwargs, args):
+    global worker_parser, worker_args
+
+    worker_parser = LogParser(**parser_kwargs)
+    worker_args = args
+
+    # close the parser when the worker process exits
+    Finalize(worker_parser, worker_parser.close, exitpriority=10)
+
+
+def get_shards(input_path, shard_size=SHARD_SIZE, parallel=False):
+    # a shard is the byte range of an uncompressed file, or the data of a compressed file, which can not be
+    # seeked efficiently, it is decompressed in this process and passed to the workers in shards of lines
+    if Path(input_path).suffix in ['.gz', '.xz', '.zst']:
+        with open_log_file(input_path, 'rb', log=False, parallel=parallel) as fp:
+            start = 0
+            for data in iter(lambda: b''.join(fp.readlines(shard_size)), b''):
+                yield input_path, start, start + len(data), data
+                start += len(data)
+
+        if start == 0:
+            yield input_path, 0, 0, b''
+        return
+
+    with open_log_file(input_path, 'rb', log=False) as fp:
+        size = fp.seek(0, io.SEEK_END)
+
+        # move every boundary to the start of the next line
+        start = 0
+        while start < size:
+            fp.seek(start + shard_size)
+            fp.readline()
+            end = min(fp.tell(), size)
+            yield input_path, start, end, None
+            start = end
+
+    if size == 0:
+        yield input_path, 0, 0, None
+
+
+def read_shard(input_path, start, end, data):
+    if data is None:
+        with open_log_file(input_path, 'rb', log=False) as fp:
+            fp.seek(start)
+            data = fp.read(end - start)
+
+    return io.BytesIO(data)
+
+
+def parse_shard(input_path, start, end, data):
+    # log entries are returned in a LogBatch, which is much more compact to transfer
+    rows = LogBatch() if worker_args.format else []
+
+    # the worker of the first shard reads (or creates) the salts for the dates of the whole file
+    if start == 0:
+        worker_parser.preload_salts(input_path)
+
+    with read_shard(input_path, start, end, data) as fp:
+        lines = read_lines(fp)
+        for log_lines in iter(lambda: list(islice(lines, worker_args.chunking)), []):
+            for log_entry, log_line in worker_parser.parse_lines(log_lines):
+                rows.append(log_entry if worker_args.format else log_line)
+
+    return rows, worker_parser.pop_stats(), worker_parser.pop_counts()
+
+
+def parse_parallel(input_paths, parser_kwargs, args):
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(parser_kwargs, args)) as executor:
+        # keep a bounded number of shards in flight and yield the results in order
+        futures = deque()
+        for input_path in input_paths:
+            logger.info('read %s (%s workers)', input_path, args.workers)
+
+            for shard in get_shards(input_path, parallel=args.parallel_compression):
+                futures.append((input_path, executor.submit(parse_shard, *shard)))
+
+                if len(futures) >= 2 * args.workers:
+                    shard_path, future = futures.popleft()
+                    yield (shard_path, *future.result())
+
+        while futures:
+            shard_path, future = futures.popleft()
+            yield (shard_path, *future.result())
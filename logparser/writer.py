@@ -1,87 +1,248 @@
+import asyncio
+import contextlib
 import csv
-from datetime import datetime
+import os
+import queue
+import threading
 
-from .models import LogEntry
-from .utils import open_log_file
+from .models import LogBatch, LogEntry
+from .utils import get_tmp_path, open_log_file
 
 
 class Writer:
 
-    def __init__(self, format=None, chunking=None, path=None, database_settings=None):
+    def __init__(self, format=None, chunking=None, path=None, database_settings=None, append=False, stats=None,
+                 parallel=False, orjson=False, pipeline=None, rollup=None,
+                 partition=False):
         self.format = format
         self.chunking = chunking
         self.path = path
+
+        # new files are written to a temporary file, which is renamed on close, so that
+        # an interrupted run does not leave an incomplete output behind
+        if path and not append:
+            self.tmp_path = get_tmp_path(path)
+        else:
+            self.tmp_path = None
         self.database_settings = database_settings
+        self.append_output = append
+        self.parallel = parallel
+        self.orjson = orjson
+        self.rollup = rollup
+        self.partition = partition
 
-        self.rows = []
+        # with a pipeline, the chunks are written by a separate thread, the queue holds at most pipeline chunks,
+        # so that the parsing waits when the writing falls behind
+        self.pipeline = pipeline
+        self.queue = self.thread = self.error = None
 
-        self.current_date = None
-        self.current_records = set()
+        # with stats, the time of write is measured and the bytes written are counted
+        self.stats = stats
+        if self.stats is not None:
+            self.write_rows = self.stats.timed('write', self.write_rows)
+
+        self.rows = self.get_buffer()
 
     def open(self):
         if self.format == 'sql':
-            from .database import create_session
-            self.session = create_session(self.database_settings)
+            from .database import create_async_database, create_database, is_async_database
+
+            if is_async_database(self.database_settings):
+                # the async engine runs in its own event loop, in the writer thread when a pipeline is used
+                self.loop = asyncio.new_event_loop()
+                self.engine = self.loop.run_until_complete(create_async_database(self.database_settings,
+                                                                                 self.partition))
+            else:
+                self.loop = None
+                self.engine = create_database(self.database_settings, self.partition)
+
+            # the monthly partitions of the records table, which were already created
+            self.partitions = set() if self.partition else None
+
+        elif self.format in ['parquet', 'arrow']:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            if self.append_output:
+                raise RuntimeError(f'Appending is not supported for the {self.format} format')
+            if self.rollup:
+                raise RuntimeError(f'Rollups are not supported for the {self.format} format')
+
+            self.initial_size = 0
+            self.schema = get_arrow_schema()
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+
+            if self.format == 'parquet':
+                self.writer = pq.ParquetWriter(self.tmp_path, self.schema)
+            else:
+                self.fp = pa.OSFile(str(self.tmp_path), 'wb')
+                self.writer = pa.ipc.new_file(self.fp, self.schema)
 
         else:
-            self.fp = open_log_file(self.path, 'wt')
-
-            if self.format in ['csv', 'csv.gz', 'csv.xz']:
-                self.writer = csv.DictWriter(self.fp, fieldnames=LogEntry.get_fields())
-                self.writer.writeheader()
-
+            # when appending, the csv header is only written to new files
+            header = not (self.append_output and self.path and self.path.exists())
+            if self.append_output:
+                self.initial_size = self.path.stat().st_size if self.path and self.path.exists() else 0
+                self.fp = open_log_file(self.path, 'at', parallel=self.parallel)
+            else:
+                self.initial_size = 0
+                self.fp = open_log_file(self.tmp_path or self.path, 'wt', parallel=self.parallel)
+
+            if self.format in ['csv', 'csv.gz', 'csv.xz', 'csv.zst']:
+                self.writer = csv.writer(self.fp)
+                if header:
+                    self.writer.writerow(self.rows.fields)
+
+        if self.pipeline:
+            self.queue = queue.Queue(int(self.pipeline))
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def get_buffer(self):
+        # log entries are buffered column-wise or aggregated in a rollup, raw log lines in a plain list
+        if self.rollup:
+            from .rollup import Rollup
+            return Rollup(**self.rollup)
+        else:
+            return LogBatch() if self.format else []
 
     def append(self, row):
         self.rows.append(row)
 
+    def extend(self, rows):
+        self.rows.extend(rows)
+
     def chunk(self):
+        # rollups are written once, when the writer is closed
+        if self.rollup:
+            return False
+
         return (self.chunking and len(self.rows) >= int(self.chunking))
 
     def write(self):
-        if self.format == 'sql':
-            self.session.bulk_save_objects(self.get_records())
-            self.session.commit()
-
-        elif self.format in ['json', 'json.gz', 'json.xz']:
-            self.fp.writelines([
-                row.to_json() for row in self.rows
-            ])
-        elif self.format in ['csv', 'csv.gz', 'csv.xz']:
-            self.writer.writerows([
-                row.serialize() for row in self.rows
-            ])
+        if self.thread:
+            # raise the errors of the writer thread in the main thread
+            if self.error:
+                raise self.error
+
+            self.queue.put(self.rows)
         else:
-            self.fp.writelines(self.rows)
+            self.write_rows(self.rows)
 
         # reset row buffer
-        self.rows = []
-
-    def close(self):
+        self.rows = self.get_buffer()
+
+    def run(self):
+        while True:
+            rows = self.queue.get()
+            if rows is None:
+                break
+
+            # after an error, the queue is still emptied, so that write does not block
+            if self.error is None:
+                try:
+                    self.write_rows(rows)
+                except Exception as e:
+                    self.error = e
+
+    def write_rows(self, rows):
         if self.format == 'sql':
-            self.session.close()
+            if self.rollup:
+                from .database import insert_rollups, insert_rollups_async
+                insert, insert_async, args = insert_rollups, insert_rollups_async, (rows, )
+            else:
+                from .database import insert_records, insert_records_async
+                insert, insert_async, args = insert_records, insert_records_async, (rows, self.partitions)
+
+            if self.loop:
+                self.loop.run_until_complete(insert_async(self.engine, *args))
+            else:
+                insert(self.engine, *args)
+
+        elif self.format in ['json', 'json.gz', 'json.xz', 'json.zst']:
+            self.fp.write(rows.to_json(self.orjson))
+        elif self.format in ['csv', 'csv.gz', 'csv.xz', 'csv.zst']:
+            self.writer.writerows(rows.serialize())
+        elif self.format in ['parquet', 'arrow']:
+            # every chunk is written as one row group (or record batch)
+            if len(rows):
+                self.writer.write_table(self.get_table(rows), len(rows))
         else:
-            self.fp.close()
+            self.fp.writelines(rows)
 
-    def get_records(self):
-        from .database import Record, get_current_records
+    def get_table(self, rows):
+        import pyarrow as pa
 
-        driver = self.session.get_bind().driver
+        columns = []
+        for field, column in zip(self.schema, rows.columns):
+            if pa.types.is_dictionary(field.type):
+                columns.append(pa.array(column, field.type.value_type).dictionary_encode())
+            else:
+                columns.append(pa.array(column, field.type))
 
-        for log_entry in self.log_entries:
-            entry_date = datetime.fromisoformat(log_entry['time']).date()
-            if entry_date != self.current_date:
-                self.current_date = entry_date
-                self.current_records = get_current_records(self.session, entry_date)
+        return pa.Table.from_arrays(columns, schema=self.schema)
 
-            if log_entry['sha1'] not in self.current_records:
-                self.current_records.add(log_entry['sha1'])
-
-                if driver in ['sqlite']:
-                    log_entry['date'] = datetime.strptime(log_entry['date'], '%Y-%m-%d')
-                elif driver in ['mysqldb']:
-                    for char_field in ['host', 'path', 'query', 'referrer_scheme', 'referrer_host',
-                                       'referrer_path', 'referrer_query', 'agent']:
-                        log_entry[char_field] = \
-                            log_entry[char_field][:384] if log_entry.get(char_field) else log_entry.get(char_field)
+    def close(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
 
-                yield Record(**log_entry)
+        if self.format == 'sql':
+            if self.loop:
+                self.loop.run_until_complete(self.engine.dispose())
+                self.loop.close()
+            else:
+                self.engine.dispose()
+        else:
+            if self.format in ['parquet', 'arrow']:
+                self.writer.close()
+            if self.format != 'parquet':
+                self.fp.close()
+
+            if self.tmp_path:
+                if self.error:
+                    self.tmp_path.unlink()
+                    raise self.error
+
+                os.replace(self.tmp_path, self.path)
+
+            if self.stats is not None and self.path:
+                self.stats.counts['bytes_written'] += self.path.stat().st_size - self.initial_size
+
+        if self.error:
+            raise self.error
+
+    def abort(self):
+        # stop the writer thread and remove the temporary file after an error, the errors while closing are
+        # ignored, since the output is incomplete anyway
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        with contextlib.suppress(Exception):
+            if self.format in ['parquet', 'arrow']:
+                self.writer.close()
+            if self.format not in ['sql', 'parquet']:
+                self.fp.close()
+
+        if self.tmp_path:
+            self.tmp_path.unlink(missing_ok=True)
+
+
+def get_arrow_schema():
+    # the strings of the low-cardinality fields are dictionary-encoded, the time is stored in UTC
+    import pyarrow as pa
+
+    types = {
+        'time': pa.timestamp('us', tz='UTC'),
+        'status': pa.int32(),
+        'size': pa.int64(),
+        'request_time': pa.float64(),
+        'upstream_response_time': pa.float64()
+    }
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+
+    return pa.schema([
+        (field, types.get(field, dictionary if field in LogBatch.interned_fields else pa.string()))
+        for field in LogEntry.get_fields()
+    ])